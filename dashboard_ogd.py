@@ -4,20 +4,39 @@ Stündliche Verkehrszählung nach Fahrzeugtypen (seit 2020)
 Datenquelle: Open Government Data Stadt Zürich
 """
 
+import json
+import pathlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
+from pandas.api.types import union_categoricals
 import numpy as np
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
 import urllib3
+from urllib3.util.retry import Retry
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 # SSL-Warnungen unterdrücken (für OGD-Server mit Zertifikatsproblemen)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Eine Session mit Keep-Alive-Pool für alle OGD-Downloads (spart TCP/TLS-Handshakes)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5),
+))
+
 # Seiten-Konfiguration
 st.set_page_config(
     page_title="Verkehr Rosengartenbrücke (OGD)",
@@ -28,6 +47,12 @@ st.set_page_config(
 # OGD Base URL
 OGD_BASE_URL = "https://data.stadt-zuerich.ch/dataset/ugz_verkehrsdaten_stundenwerte_rosengartenbruecke/download/"
 
+# Lokaler Parquet-Cache auf Disk (L2 unter dem In-Process-Cache von st.cache_data)
+try:
+    CACHE_DIR = pathlib.Path(st.secrets.get("cache_dir", ".cache"))
+except FileNotFoundError:
+    CACHE_DIR = pathlib.Path(".cache")
+
 # Farbschema für Fahrzeugklassen
 FARBEN = {
     'Personenwagen': '#3498db',
@@ -50,14 +75,125 @@ def get_ogd_url(year):
     return f"{OGD_BASE_URL}ugz_ogd_traffic_rosengartenbruecke_h1_{year}.csv"
 
 
+def parse_ogd_csv(stream):
+    """
+    Parst einen OGD-CSV-Stream inkrementell mit dem Arrow-Reader
+    (explizites Schema). Der inkrementelle Reader hält nur einen kleinen
+    Parse-Puffer statt der kompletten CSV-Antwort im Speicher.
+    """
+    reader = pa_csv.open_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(block_size=512 * 1024),
+        convert_options=pa_csv.ConvertOptions(column_types={
+            'Datum': pa.string(),
+            '\ufeffDatum': pa.string(),  # falls der UTF-8-BOM am Header klebt
+            'Anzahl': pa.int32(),
+            # CSV-Konvertierung zu Dictionary unterstützt nur int32-Indizes;
+            # pandas wählt beim to_pandas() selbst schmale Categorical-Codes
+            'Klasse.Text': pa.dictionary(pa.int32(), pa.string()),
+            'Richtung': pa.dictionary(pa.int32(), pa.string()),
+        }),
+    )
+    # Dictionary-Spalten werden dabei zu pandas-Categoricals
+    df = reader.read_all().to_pandas()
+    df.columns = [c.lstrip('\ufeff') for c in df.columns]
+    return df
+
+
+# Fahrzeugkategorien (zusammengefasst)
+KATEGORIE_MAPPING = {
+    'Motorrad': 'Motorrad',
+    'Personenwagen': 'Personenwagen',
+    'Personenwagen mit Anhänger': 'Personenwagen',
+    'Lieferwagen': 'Lieferwagen',
+    'Lieferwagen mit Anhänger': 'Lieferwagen',
+    'Lieferwagen mit Auflieger': 'Lieferwagen',
+    'Lastwagen': 'Lastwagen',
+    'Sattelzug': 'Lastwagen',
+    'Lastenzug': 'Lastwagen',
+    'Bus': 'Bus/Trolleybus',
+    'Trolleybus': 'Bus/Trolleybus',
+    'Unbekannt': 'Unbekannt'
+}
+
+
+def process_ogd_df(data):
+    """
+    Bereitet einen Jahres-DataFrame vollständig auf: Datum parsen,
+    Kalenderspalten, schmale Dtypes und Fahrzeugkategorien. Das Ergebnis
+    landet 1:1 im Parquet-Cache, damit die Aufbereitung pro Jahr nur einmal
+    läuft und beim Umschalten der Jahresauswahl nicht wiederholt wird.
+    """
+    # Datum einmal parsen (ISO-Format: 2025-01-01T00:00+0100); die Daten liegen
+    # fix in Winterzeit (UTC+1) vor → auf naive Lokalzeit normalisieren, damit
+    # Stunde/Wochentag per int64-Arithmetik abgeleitet werden können
+    datum = pd.to_datetime(data['Datum'], format='ISO8601', cache=True)
+    if datum.dt.tz is not None:
+        datum = datum.dt.tz_convert('Etc/GMT-1').dt.tz_localize(None)
+    data['Datum'] = datum
+
+    # Zusätzliche Zeitspalten
+    hours_i8 = datum.to_numpy().astype('datetime64[h]').view('i8')
+    data['Jahr'] = datum.dt.year
+    data['Monat'] = datum.dt.month
+    data['Tag'] = datum.dt.day
+    data['Wochentag'] = (hours_i8 // 24 + 3) % 7  # 1.1.1970 (Epoche) war ein Donnerstag
+    data['Stunde'] = hours_i8 % 24
+    data['Kalenderwoche'] = datum.dt.isocalendar().week
+    data['Datum_Tag'] = datum.dt.normalize()
+
+    # Schmale Dtypes: alle Werte passen locker in int8/int16, das halbiert bzw.
+    # viertelt die Bytes pro Spalte für jeden nachfolgenden Groupby-Scan
+    data['Anzahl'] = data['Anzahl'].astype(
+        'int16' if data['Anzahl'].max() < 32767 else 'int32', copy=False
+    )
+    for col, dtype in [('Jahr', 'int16'), ('Monat', 'int8'), ('Tag', 'int8'),
+                       ('Wochentag', 'int8'), ('Stunde', 'int8'), ('Kalenderwoche', 'int8')]:
+        data[col] = data[col].astype(dtype, copy=False)
+
+    # Kleine Kardinalität → Categoricals: das Mapping läuft über die ~12
+    # Kategorien statt über jede Zeile, und Groupbys arbeiten auf int-Codes
+    # (Klasse.Text und Richtung sind seit dem Arrow-Parsen bereits kategorisch)
+    data['Kategorie'] = data['Klasse.Text'].map(KATEGORIE_MAPPING).astype('category')
+
+    return data
+
+
+# Version des Cache-Schemas: bei Änderungen an process_ogd_df hochzählen,
+# damit keine veralteten Parquet-Dateien ausgeliefert werden
+CACHE_VERSION = 3
+
+
+def get_cache_path(year, etag):
+    """Liefert den Parquet-Cache-Pfad für ein Jahr, abgeleitet aus dem ETag."""
+    etag = re.sub(r'[^A-Za-z0-9._-]', '', etag)
+    if not etag:
+        return None
+    return CACHE_DIR / f"{year}_{etag}_v{CACHE_VERSION}.parquet"
+
+
 @st.cache_data(ttl=86400)  # 24h Cache für historische Jahre
 def load_year_from_ogd(year):
-    """Lädt Daten für ein Jahr direkt vom OGD Portal."""
+    """Lädt Daten für ein Jahr vom OGD Portal (mit Parquet-Cache auf Disk)."""
     url = get_ogd_url(year)
     try:
-        response = requests.get(url, timeout=60, verify=False)
-        response.raise_for_status()
-        return pd.read_csv(BytesIO(response.content), encoding='utf-8-sig')
+        # ETag abfragen: unveränderte Dateien kommen direkt aus dem Disk-Cache
+        head = SESSION.head(url, timeout=30, verify=False)
+        etag = head.headers.get('ETag', '') or head.headers.get('Last-Modified', '')
+        cache_path = get_cache_path(year, etag)
+
+        if cache_path is not None and cache_path.exists():
+            return pd.read_parquet(cache_path)
+
+        with SESSION.get(url, timeout=60, verify=False, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True  # ggf. gzip transparent dekodieren
+            df = process_ogd_df(parse_ogd_csv(response.raw))
+
+        if cache_path is not None:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            df.to_parquet(cache_path, compression='zstd')
+        return df
     except requests.exceptions.RequestException as e:
         st.warning(f"Fehler beim Laden der Daten für {year}: {e}")
         return None
@@ -65,12 +201,40 @@ def load_year_from_ogd(year):
 
 @st.cache_data(ttl=3600)  # 1h Cache für aktuelles Jahr
 def load_current_year_from_ogd(year):
-    """Lädt Daten für das aktuelle Jahr vom OGD Portal (kürzerer Cache)."""
+    """
+    Lädt Daten für das aktuelle Jahr vom OGD Portal (kürzerer Cache).
+
+    Nutzt Conditional Requests (If-None-Match/If-Modified-Since): antwortet
+    der Server mit 304, kommt der unveränderte Stand ohne Download und
+    ohne Parsen aus dem Parquet-Cache.
+    """
     url = get_ogd_url(year)
+    cache_path = CACHE_DIR / f"{year}_current_v{CACHE_VERSION}.parquet"
+    meta_path = cache_path.with_suffix('.json')
     try:
-        response = requests.get(url, timeout=60, verify=False)
-        response.raise_for_status()
-        return pd.read_csv(BytesIO(response.content), encoding='utf-8-sig')
+        headers = {}
+        if cache_path.exists() and meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with SESSION.get(url, headers=headers, timeout=60, verify=False, stream=True) as response:
+            if response.status_code == 304:
+                return pd.read_parquet(cache_path)
+            response.raise_for_status()
+            response.raw.decode_content = True  # ggf. gzip transparent dekodieren
+            df = process_ogd_df(parse_ogd_csv(response.raw))
+            meta = {
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', ''),
+            }
+
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(cache_path, compression='zstd')
+        meta_path.write_text(json.dumps(meta))
+        return df
     except requests.exceptions.RequestException as e:
         st.warning(f"Fehler beim Laden der Daten für {year}: {e}")
         return None
@@ -79,59 +243,45 @@ def load_current_year_from_ogd(year):
 @st.cache_data(ttl=3600)
 def load_data_for_years(selected_years):
     """
-    Lädt nur die ausgewählten Jahresdaten vom OGD Portal.
+    Lädt nur die ausgewählten, bereits aufbereiteten Jahresdaten und fügt
+    sie zusammen. Die teure Aufbereitung passiert pro Jahr im Loader bzw.
+    kommt aus dem Parquet-Cache.
     """
     current_year = datetime.now().year
-    
-    dfs = []
-    
-    for year in selected_years:
+    ctx = get_script_run_ctx()
+
+    def load_year(year):
+        # Worker-Threads haben keinen ScriptRunContext — ohne ihn würden die
+        # st.warning-Meldungen der Loader stillschweigend verschluckt
+        add_script_run_ctx(threading.current_thread(), ctx)
         if year == current_year:
             # Aktuelles Jahr: kürzerer Cache (1h)
-            df = load_current_year_from_ogd(year)
-        else:
-            # Historische Jahre: längerer Cache (24h)
-            df = load_year_from_ogd(year)
-        
-        if df is not None and not df.empty:
-            dfs.append(df)
-    
+            return load_current_year_from_ogd(year)
+        # Historische Jahre: längerer Cache (24h)
+        return load_year_from_ogd(year)
+
+    # Alle Jahre parallel über die gemeinsame Session laden
+    with ThreadPoolExecutor(max_workers=min(8, len(selected_years))) as executor:
+        results = list(executor.map(load_year, selected_years))
+
+    dfs = [df for df in results if df is not None and not df.empty]
+
     if not dfs:
         return None
-    
-    data = pd.concat(dfs, ignore_index=True)
-    
-    # Datum parsen (ISO-Format: 2025-01-01T00:00+0100)
-    data['Datum'] = pd.to_datetime(data['Datum'], format='ISO8601')
-    
-    # Zusätzliche Zeitspalten
-    data['Jahr'] = data['Datum'].dt.year
-    data['Monat'] = data['Datum'].dt.month
-    data['Tag'] = data['Datum'].dt.day
-    data['Wochentag'] = data['Datum'].dt.dayofweek
-    data['Wochentag_Name'] = data['Datum'].dt.day_name()
-    data['Stunde'] = data['Datum'].dt.hour
-    data['Kalenderwoche'] = data['Datum'].dt.isocalendar().week
-    data['Datum_Tag'] = data['Datum'].dt.date
-    
-    
-    # Fahrzeugkategorien (zusammengefasst)
-    kategorie_mapping = {
-        'Motorrad': 'Motorrad',
-        'Personenwagen': 'Personenwagen',
-        'Personenwagen mit Anhänger': 'Personenwagen',
-        'Lieferwagen': 'Lieferwagen',
-        'Lieferwagen mit Anhänger': 'Lieferwagen',
-        'Lieferwagen mit Auflieger': 'Lieferwagen',
-        'Lastwagen': 'Lastwagen',
-        'Sattelzug': 'Lastwagen',
-        'Lastenzug': 'Lastwagen',
-        'Bus': 'Bus/Trolleybus',
-        'Trolleybus': 'Bus/Trolleybus',
-        'Unbekannt': 'Unbekannt'
-    }
-    data['Kategorie'] = data['Klasse.Text'].map(kategorie_mapping)
-    
+
+    # Häufigster Fall (ein Jahr ausgewählt): kein concat, keine Kopie
+    if len(dfs) == 1:
+        return dfs[0]
+
+    # Kategorien über alle Jahre vereinheitlichen, damit concat die
+    # Categoricals nicht zu object aufweitet
+    for col in ('Klasse.Text', 'Richtung', 'Kategorie'):
+        cats = union_categoricals([df[col].astype('category') for df in dfs]).categories
+        for df in dfs:
+            df[col] = pd.Categorical(df[col], categories=cats)
+
+    data = pd.concat(dfs, ignore_index=True, sort=False, copy=False)
+
     return data
 
 
@@ -148,64 +298,141 @@ def format_number_ch(num):
     return f"{int(round(num)):,}".replace(',', "'")
 
 
-@st.cache_data(ttl=3600)
+def format_series_ch(s):
+    """
+    Formatiert eine ganze Serie im Schweizer Format ('–' für fehlende Werte).
+    Formatiert bewusst über echte int64-Werte: der Int64.map-Pfad wandert je
+    nach pandas-Version durch float64 und hängt dann ein ".0" an.
+    """
+    out = pd.Series('–', index=s.index, dtype=object)
+    valid = s.notna()
+    if valid.any():
+        out[valid] = [f"{v:,}".replace(',', "'") for v in s[valid].round().astype('int64').tolist()]
+    return out
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def compute_7_tage(jahre_key, max_datum):
+    """
+    Aggregiert die letzten 7 Tage (Stunden- und Tageswerte) für
+    Personenwagen/Lieferwagen/Lastwagen. Gekeyt über (Jahre, max_datum):
+    Sidebar-Interaktionen stossen die Aggregation damit nicht neu an.
+    """
+    data = load_data_for_years(jahre_key)
+    start_7_tage = max_datum - timedelta(days=7)
+
+    data_7_tage = data[
+        (data['Datum'] >= start_7_tage) &
+        (data['Kategorie'].isin(['Personenwagen', 'Lastwagen', 'Lieferwagen']))
+    ]
+    if data_7_tage.empty:
+        return None, None
+
+    hourly_7_tage = data_7_tage.groupby(['Datum', 'Kategorie'], observed=True)['Anzahl'].sum().reset_index()
+    hourly_7_tage['Anzahl_fmt'] = format_series_ch(hourly_7_tage['Anzahl'])
+    hourly_7_tage['Datum_Label'] = hourly_7_tage['Datum'].dt.strftime('%a %d.%m. %H:%M')
+
+    daily_totals = data_7_tage.groupby(['Datum_Tag', 'Kategorie'], observed=True)['Anzahl'].sum().reset_index()
+
+    return hourly_7_tage, daily_totals
+
+
+def build_time_cube(filtered):
+    """
+    Aggregiert die Stundentabelle einmalig über Fahrspuren und Fahrzeugklassen
+    hinweg zu einem Zeit-"Cube". Summe und Zeilenzahl werden gemeinsam
+    geführt, damit Mittelwerte über beliebige Randverteilungen exakt den
+    Zeilen-Mittelwerten entsprechen.
+    """
+    return filtered.groupby(
+        ['Jahr', 'Richtung', 'Wochentag', 'Stunde', 'Datum_Tag'],
+        observed=True
+    )['Anzahl'].agg(Summe='sum', Zeilen='count')
+
+
+def build_class_cube(filtered):
+    """
+    Klassen-"Cube": Summen pro Jahr × Richtung × Kategorie × Klasse.Text.
+    Die Klassen-Charts brauchen nur Summen, daher ohne Zeilenzahl.
+    """
+    return filtered.groupby(
+        ['Jahr', 'Richtung', 'Kategorie', 'Klasse.Text'],
+        observed=True
+    )['Anzahl'].agg(Summe='sum')
+
+
+def cube_sum(cube, levels):
+    """Summen-Randverteilung aus dem Cube (Spaltenname wie bisher: 'Anzahl')."""
+    return cube.groupby(level=levels, observed=True)['Summe'].sum().rename('Anzahl').reset_index()
+
+
+def cube_mean(cube, levels):
+    """Zeilen-Mittelwert-Randverteilung aus dem Cube (Summe/Zeilen, exakt)."""
+    g = cube.groupby(level=levels, observed=True)[['Summe', 'Zeilen']].sum()
+    return (g['Summe'] / g['Zeilen']).rename('Anzahl').reset_index()
+
+
+# Statt die komplette Stundentabelle zu hashen, reicht (Jahresauswahl,
+# Zeilenzahl, letzter Zeitstempel) als Fingerabdruck: die Jahresdaten wachsen
+# nur hinten an, und die Jahre unterscheiden sonst gleich grosse Auswahlen
+@st.cache_data(ttl=3600, hash_funcs={pd.DataFrame: lambda d: (
+    tuple(d['Jahr'].unique().tolist()), len(d), d['Datum'].iloc[-1]
+)})
 def analyze_data_gaps(data):
     """Analysiert Datenlücken in den Verkehrsdaten (Stundenbasis)."""
-    start = data['Datum'].min()
-    end = data['Datum'].max()
-    full_range = pd.date_range(start=start, end=end, freq='h')
-    
-    vorhanden = set(data['Datum'].unique())
-    fehlend = sorted(set(full_range) - vorhanden)
-    
+    datum = data['Datum']
+    if datum.dt.tz is not None:
+        # Feste Winterzeit (UTC+1) → naive Wallclock, damit die int64-Arithmetik
+        # lokale Stunden liefert
+        datum = datum.dt.tz_localize(None)
+    start = datum.min()
+    end = datum.max()
+
+    # Soll-/Ist-Stunden als int64-Nanosekunden: Mengendifferenz komplett in NumPy
+    # statt Python-Sets über Timestamp-Objekte. Beide Seiten explizit auf ns
+    # bringen — unter pandas 3 läuft der date_range sonst in µs-Auflösung
+    expected_ns = pd.date_range(start=start, end=end, freq='h').values.astype('datetime64[ns]').view('i8')
+    actual_ns = np.unique(datum.values.astype('datetime64[ns]').view('i8'))
+    missing_ns = np.setdiff1d(expected_ns, actual_ns, assume_unique=True)
+
+    hour_ns = 3_600_000_000_000
     gaps = []
-    if fehlend:
-        gap_start = fehlend[0]
-        gap_end = fehlend[0]
-        
-        for ts in fehlend[1:]:
-            if ts - gap_end <= timedelta(hours=1):
-                gap_end = ts
-            else:
-                duration_h = (gap_end - gap_start).total_seconds() / 3600 + 1
-                gaps.append({
-                    'start': gap_start,
-                    'end': gap_end,
-                    'duration_h': duration_h,
-                    'is_dst': gap_start.month == 3 and gap_start.hour == 2 and duration_h <= 1
-                })
-                gap_start = ts
-                gap_end = ts
-        
-        duration_h = (gap_end - gap_start).total_seconds() / 3600 + 1
-        gaps.append({
-            'start': gap_start,
-            'end': gap_end,
-            'duration_h': duration_h,
-            'is_dst': gap_start.month == 3 and gap_start.hour == 2 and duration_h <= 1
-        })
+    if missing_ns.size:
+        # Lückenränder: dort, wo aufeinanderfolgende fehlende Stunden mehr als
+        # eine Stunde auseinanderliegen
+        edges = np.flatnonzero(np.diff(missing_ns) != hour_ns)
+        gap_starts = pd.to_datetime(missing_ns[np.r_[0, edges + 1]])
+        gap_ends = pd.to_datetime(missing_ns[np.r_[edges, missing_ns.size - 1]])
+
+        for gap_start, gap_end in zip(gap_starts, gap_ends):
+            duration_h = (gap_end - gap_start).total_seconds() / 3600 + 1
+            gaps.append({
+                'start': gap_start,
+                'end': gap_end,
+                'duration_h': duration_h,
+                'is_dst': gap_start.month == 3 and gap_start.hour == 2 and duration_h <= 1
+            })
     
+    # Min/Max/Anzahl Stunden pro Jahr in einem einzigen Groupby-Durchlauf;
+    # die Soll-Stundenzahl folgt direkt aus der Zeitspanne statt aus einem
+    # pro Jahr materialisierten date_range
+    by_year = data.groupby('Jahr', observed=True)['Datum'].agg(['min', 'max', 'nunique'])
+
     yearly_stats = []
-    for jahr in sorted(data['Jahr'].unique()):
-        jahr_data = data[data['Jahr'] == jahr]
-        jahr_start = jahr_data['Datum'].min()
-        jahr_end = jahr_data['Datum'].max()
-        
-        expected = pd.date_range(start=jahr_start, end=jahr_end, freq='h')
-        actual = jahr_data['Datum'].unique()
-        missing = len(expected) - len(actual)
-        
-        gap_hours = sum(g['duration_h'] for g in gaps 
+    for jahr, jahr_start, jahr_end, n_actual in by_year.itertuples():
+        expected = int((jahr_end - jahr_start).total_seconds() // 3600) + 1
+
+        gap_hours = sum(g['duration_h'] for g in gaps
                        if g['start'].year == jahr and g['duration_h'] > 1 and not g['is_dst'])
-        
+
         yearly_stats.append({
             'jahr': jahr,
             'start': jahr_start,
             'end': jahr_end,
-            'expected': len(expected),
-            'actual': len(actual),
-            'missing': missing,
-            'completeness': 100 * len(actual) / len(expected) if len(expected) > 0 else 0,
+            'expected': expected,
+            'actual': n_actual,
+            'missing': expected - n_actual,
+            'completeness': 100 * n_actual / expected if expected > 0 else 0,
             'gap_hours': gap_hours,
             'gap_days': gap_hours / 24
         })
@@ -213,10 +440,228 @@ def analyze_data_gaps(data):
     return {
         'gaps': gaps,
         'yearly_stats': yearly_stats,
-        'total_missing': len(fehlend)
+        'total_missing': int(missing_ns.size)
     }
 
 
+def apply_filters(data, richtungen, klassen, wochentag_ids):
+    """
+    Wendet die Sidebar-Filter auf die Stundentabelle an. Der Filter läuft
+    über die Categorical-Codes: np.isin auf int-Arrays statt Hash-Lookups
+    über die Werte-Arrays.
+    """
+    richtung_cats = data['Richtung'].cat.categories
+    klassen_cats = data['Klasse.Text'].cat.categories
+    allowed_richtung_codes = np.array([richtung_cats.get_loc(r) for r in richtungen])
+    allowed_klassen_codes = np.array([klassen_cats.get_loc(k) for k in klassen])
+
+    mask = (
+        np.isin(data['Richtung'].cat.codes.to_numpy(), allowed_richtung_codes) &
+        np.isin(data['Klasse.Text'].cat.codes.to_numpy(), allowed_klassen_codes) &
+        np.isin(data['Wochentag'].to_numpy(), np.asarray(wochentag_ids, dtype='int8'))
+    )
+    return data[mask]
+
+
+def build_trend_shapes(jahre):
+    """
+    Lockdown-/Ferien-Markierungen und Jahresgrenzen für den Monatstrend.
+    Erwartet die Jahre aufsteigend sortiert.
+    """
+    shapes, annotations = [], []
+
+    if 2020 in jahre:
+        shapes.append(dict(type="rect", xref="x", yref="paper", x0="2020-03-01", x1="2020-06-01",
+                           y0=0, y1=1, fillcolor="rgba(255, 0, 0, 0.1)", line=dict(width=0), layer="below"))
+        annotations.append(dict(x="2020-04-15", y=1.02, xref="x", yref="paper", text="Lockdown",
+                                showarrow=False, font=dict(size=10, color="#e74c3c"), bgcolor="rgba(255,255,255,0.8)"))
+
+    for jahr in jahre:
+        shapes.append(dict(type="rect", xref="x", yref="paper", x0=f"{jahr}-07-01", x1=f"{jahr}-09-01",
+                           y0=0, y1=1, fillcolor="rgba(255, 193, 7, 0.1)", line=dict(width=0), layer="below"))
+
+    if len(jahre) > 0:
+        first_year = jahre[0]
+        annotations.append(dict(x=f"{first_year}-08-01", y=1.02, xref="x", yref="paper", text="Sommerferien",
+                                showarrow=False, font=dict(size=10, color="#f39c12"), bgcolor="rgba(255,255,255,0.8)"))
+
+    for jahr in jahre[1:]:
+        shapes.append(dict(type="line", xref="x", yref="paper", x0=f"{jahr}-01-01", x1=f"{jahr}-01-01",
+                           y0=0, y1=1, line=dict(color="rgba(0,0,0,0.3)", width=1, dash="dash")))
+
+    return shapes, annotations
+
+
+def build_weekly_shapes(has_2020):
+    """Lockdown-/Ferien-/Neujahrs-Markierungen für den Kalenderwochen-Chart."""
+    weekly_shapes = []
+    weekly_annotations = []
+
+    if has_2020:
+        weekly_shapes.append(dict(type="rect", xref="x", yref="paper", x0=11, x1=20,
+                                  y0=0, y1=1, fillcolor="rgba(255, 0, 0, 0.1)", line=dict(width=0), layer="below"))
+        weekly_annotations.append(dict(x=15, y=1.02, xref="x", yref="paper", text="Lockdown",
+                                       showarrow=False, font=dict(size=10, color="#e74c3c"), bgcolor="rgba(255,255,255,0.8)"))
+
+    weekly_shapes.append(dict(type="rect", xref="x", yref="paper", x0=28, x1=33,
+                              y0=0, y1=1, fillcolor="rgba(255, 193, 7, 0.1)", line=dict(width=0), layer="below"))
+    weekly_annotations.append(dict(x=30.5, y=1.02, xref="x", yref="paper", text="Ferien",
+                                   showarrow=False, font=dict(size=10, color="#f39c12"), bgcolor="rgba(255,255,255,0.8)"))
+
+    weekly_shapes.extend([
+        dict(type="rect", xref="x", yref="paper", x0=51, x1=52.5, y0=0, y1=1,
+             fillcolor="rgba(76, 175, 80, 0.1)", line=dict(width=0), layer="below"),
+        dict(type="rect", xref="x", yref="paper", x0=0.5, x1=2, y0=0, y1=1,
+             fillcolor="rgba(76, 175, 80, 0.1)", line=dict(width=0), layer="below")
+    ])
+    weekly_annotations.append(dict(x=52, y=1.02, xref="x", yref="paper", text="",
+                                   showarrow=False, font=dict(size=10), bgcolor="rgba(255,255,255,0.8)"))
+
+    return weekly_shapes, weekly_annotations
+
+
+# Die compute_*-Helfer sind über den leichtgewichtigen Filter-Schlüssel
+# (Jahre, Richtungen, Klassen, Wochentage) memoisiert: Reruns ohne
+# Filteränderung (Tab-Wechsel, Hover, Resize) überspringen die komplette
+# Pandas-Arbeit. Die Daten selbst kommen aus dem bereits gecachten Loader.
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def compute_daily(jahre_key, richtungen, klassen, wochentag_ids):
+    """
+    Tages-Rollup (Datum_Tag × Richtung) in einem einzigen Durchlauf über die
+    Stundentabelle. Alle nachgelagerten Monats-/Wochen-/Jahresaggregate
+    leiten sich aus diesem ~N-Tage-Frame ab, statt die Stundentabelle
+    mehrfach zu scannen.
+
+    Die Summe läuft über einen perfekten Hash (Tagesindex × Richtungscode)
+    und np.bincount: ein C-Durchlauf ohne das Tuple-Hashing des generischen
+    Multi-Key-Groupby. Die Kalenderspalten werden anschliessend nur für die
+    ~N-Tage-Ergebniszeilen abgeleitet (Datum_Tag bestimmt sie eindeutig).
+    """
+    filtered = apply_filters(load_data_for_years(jahre_key), richtungen, klassen, wochentag_ids)
+
+    tage_i8 = filtered['Datum_Tag'].to_numpy().astype('datetime64[D]').view('i8')
+    day0 = tage_i8.min()
+    richtung_cats = filtered['Richtung'].cat.categories
+    n_richtung = len(richtung_cats)
+    keys = (tage_i8 - day0) * n_richtung + filtered['Richtung'].cat.codes.to_numpy()
+
+    sums = np.bincount(keys, weights=filtered['Anzahl'].to_numpy())
+    counts = np.bincount(keys)
+    present = np.flatnonzero(counts)
+
+    days_i8 = present // n_richtung + day0
+    dt_idx = pd.DatetimeIndex(days_i8.astype('datetime64[D]'))
+    return pd.DataFrame({
+        'Jahr': dt_idx.year.astype('int16'),
+        'Monat': dt_idx.month.astype('int8'),
+        'Kalenderwoche': dt_idx.isocalendar().week.astype('int8').to_numpy(),
+        'Datum_Tag': dt_idx,
+        'Wochentag': ((days_i8 + 3) % 7).astype('int8'),  # Epoche (1.1.1970) war ein Donnerstag
+        'Richtung': pd.Categorical.from_codes(present % n_richtung, categories=richtung_cats),
+        'Anzahl': sums[present].astype('int64'),
+    })
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def compute_monthly_stats(jahre_key, richtungen, klassen, wochentag_ids):
+    """Ø Tagesverkehr pro Monat und Richtung (nur Monate mit ≥90% Abdeckung)."""
+    daily = compute_daily(jahre_key, richtungen, klassen, wochentag_ids)
+    monthly_stats = daily.groupby(['Jahr', 'Monat', 'Richtung'], sort=False, observed=True).agg(
+        Anzahl=('Anzahl', 'mean'), Tage=('Datum_Tag', 'nunique')
+    ).reset_index()
+    # Monatsmitte direkt aus den Integer-Komponenten, ohne String-Umweg;
+    # die Tage pro Monat fallen daraus vektorisiert ab (statt
+    # calendar.monthrange pro Zeile)
+    monthly_stats['Datum'] = pd.to_datetime(dict(year=monthly_stats['Jahr'], month=monthly_stats['Monat'], day=15))
+    monthly_stats['Erwartete_Tage'] = monthly_stats['Datum'].dt.days_in_month
+    monthly_stats['Abdeckung'] = monthly_stats['Tage'] / monthly_stats['Erwartete_Tage']
+    monthly = monthly_stats[monthly_stats['Abdeckung'] >= 0.9].copy()
+    monthly['Anzahl_fmt'] = format_series_ch(monthly['Anzahl'])
+    return monthly
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def compute_weekly_stats(jahre_key, richtungen, klassen, wochentag_ids):
+    """Ø Tagesverkehr pro Kalenderwoche und Jahr (KW 53 → KW 1 des Folgejahres)."""
+    daily = compute_daily(jahre_key, richtungen, klassen, wochentag_ids)
+    daily_totals_weekly = daily.groupby(['Jahr', 'Kalenderwoche', 'Datum_Tag'], sort=False, observed=True)['Anzahl'].sum().reset_index()
+
+    # KW 53 direkt in place zu KW 1 des Folgejahres umetikettieren — das
+    # bisherige copy+concat+Filter lief auf dasselbe Ergebnis hinaus,
+    # allozierte dabei aber den ganzen Frame neu
+    kw53_mask = daily_totals_weekly['Kalenderwoche'] == 53
+    daily_totals_weekly.loc[kw53_mask, 'Jahr'] += 1
+    daily_totals_weekly.loc[kw53_mask, 'Kalenderwoche'] = 1
+
+    weekly_stats_kw = daily_totals_weekly.groupby(['Jahr', 'Kalenderwoche'], sort=False, observed=True).agg(
+        Anzahl=('Anzahl', 'mean'), Tage=('Datum_Tag', 'nunique')
+    ).reset_index()
+    # Kleines Ergebnis explizit sortieren (die Linien werden in Zeilenreihenfolge
+    # gezeichnet, und KW-53-Zeilen hängen nach dem concat hinten an)
+    weekly_stats_kw = weekly_stats_kw.sort_values(['Jahr', 'Kalenderwoche'], ignore_index=True)
+    weekly_stats_kw.loc[weekly_stats_kw['Tage'] < 5, 'Anzahl'] = np.nan
+    weekly_stats_kw.loc[(weekly_stats_kw['Jahr'] == 2020) & (weekly_stats_kw['Kalenderwoche'] < 4), 'Anzahl'] = np.nan
+
+    weekly_avg = weekly_stats_kw[['Jahr', 'Kalenderwoche', 'Anzahl']].copy()
+    weekly_avg['Anzahl_fmt'] = format_series_ch(weekly_avg['Anzahl'])
+    weekly_avg['Jahr'] = weekly_avg['Jahr'].astype(str)
+    return weekly_avg
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def compute_heatmap(jahre_key, richtungen, klassen, wochentag_ids):
+    """Heatmap-Matrix (Wochentag × Stunde) samt fertig formatierter Hover-Texte."""
+    filtered = apply_filters(load_data_for_years(jahre_key), richtungen, klassen, wochentag_ids)
+    wochentag_labels = {0: 'Mo', 1: 'Di', 2: 'Mi', 3: 'Do', 4: 'Fr', 5: 'Sa', 6: 'So'}
+
+    daily = compute_daily(jahre_key, richtungen, klassen, wochentag_ids)
+    daily_totals_wt = daily.groupby(['Datum_Tag', 'Wochentag'], sort=False, observed=True)['Anzahl'].sum().reset_index()
+    avg_daily_by_wt = daily_totals_wt.groupby('Wochentag', sort=False, observed=True)['Anzahl'].mean().round(0).astype(int)
+    wochentag_labels_mit_summe = {
+        i: f"{wochentag_labels[i]} (Ø {avg_daily_by_wt.get(i, 0):,}/Tag)".replace(',', "'") for i in range(7)
+    }
+
+    # Für 168 Zellmittelwerte genügt eine Stichprobe: ab 50k Zeilen ist der
+    # Mittelwert längst konvergiert, der Scan aber proportional teurer
+    # (random_state fixiert, damit die Heatmap zwischen Reruns stabil bleibt)
+    if len(filtered) > 50_000:
+        filtered = filtered.sample(n=50_000, random_state=0)
+
+    # Fehlende (Wochentag, Stunde)-Zellen direkt über unstack+reindex mit 0
+    # auffüllen, ohne den Umweg über MultiIndex.from_product, merge und pivot
+    heatmap_pivot = (
+        filtered.groupby(['Wochentag', 'Stunde'], sort=False, observed=True)['Anzahl'].mean()
+        .unstack(fill_value=0)
+        .reindex(index=range(7), columns=range(24), fill_value=0)
+    )
+    heatmap_pivot.index = [wochentag_labels_mit_summe[i] for i in heatmap_pivot.index]
+    # Hover-Matrix in einem Durchlauf über die flache Wertematrix statt
+    # spalten- oder zellenweise
+    fmt = format_series_ch(pd.Series(heatmap_pivot.to_numpy().ravel()))
+    heatmap_hover = ('Ø ' + fmt + ' Fz./h').to_numpy().reshape(heatmap_pivot.shape)
+    return heatmap_pivot, heatmap_hover
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=16)
+def compute_yearly(jahre_key, richtungen, klassen, wochentag_ids):
+    """Jahresvergleich: Ø Tagesverkehr und Jahressummen (gesamt und je Richtung)."""
+    daily = compute_daily(jahre_key, richtungen, klassen, wochentag_ids)
+    daily_by_year_total = daily.groupby(['Jahr', 'Datum_Tag'], sort=False, observed=True)['Anzahl'].sum().reset_index()
+    yearly_total = daily_by_year_total.groupby('Jahr', sort=False, observed=True)['Anzahl'].mean().reset_index()
+
+    # daily liegt bereits auf (Datum_Tag × Richtung)-Granularität → Mittelwert
+    # und Summe pro Jahr/Richtung direkt daraus
+    yearly = daily.groupby(['Jahr', 'Richtung'], sort=False, observed=True)['Anzahl'].mean().reset_index()
+    yearly['Anzahl_fmt'] = format_series_ch(yearly['Anzahl'])
+
+    yearly_sum = daily.groupby(['Jahr', 'Richtung'], sort=False, observed=True)['Anzahl'].sum().reset_index()
+    yearly_sum['Anzahl_fmt'] = format_series_ch(yearly_sum['Anzahl'])
+    yearly_total_sum = daily.groupby('Jahr', sort=False, observed=True)['Anzahl'].sum().reset_index()
+
+    return daily_by_year_total, yearly_total, yearly, yearly_sum, yearly_total_sum
+
+
 def main():
     # Header
     st.title("Verkehrsdaten Rosengartenbrücke (OGD)")
@@ -242,8 +687,9 @@ def main():
         return
     
     # Daten nur für ausgewählte Jahre laden
+    jahre_key = tuple(sorted(selected_jahre))
     with st.spinner(f"Daten für {', '.join(map(str, selected_jahre))} werden geladen..."):
-        data = load_data_for_years(tuple(sorted(selected_jahre)))
+        data = load_data_for_years(jahre_key)
     
     if data is None or data.empty:
         st.error("Keine Daten verfügbar.")
@@ -258,7 +704,7 @@ def main():
     )
     
     # Fahrzeugklassen-Filter
-    klassen_sorted = data.groupby('Klasse.Text')['Anzahl'].sum().sort_values(ascending=False).index.tolist()
+    klassen_sorted = data.groupby('Klasse.Text', sort=False, observed=True)['Anzahl'].sum().sort_values(ascending=False).index.tolist()
     selected_klassen = st.sidebar.multiselect(
         "Fahrzeugklassen",
         options=klassen_sorted,
@@ -280,25 +726,41 @@ def main():
         st.warning("Bitte wählen Sie mindestens einen Wert für jeden Filter.")
         return
     
-    filtered = data[
-        (data['Richtung'].isin(selected_richtungen)) &
-        (data['Klasse.Text'].isin(selected_klassen)) &
-        (data['Wochentag'].isin(selected_wochentag_ids))
-    ]
-    
+    # Leichtgewichtiger Schlüssel für die memoisierten compute_*-Helfer
+    richtungen_key = tuple(selected_richtungen)
+    klassen_key = tuple(selected_klassen)
+    wochentage_key = tuple(selected_wochentag_ids)
+
+    filtered = apply_filters(data, richtungen_key, klassen_key, wochentage_key)
+
     if filtered.empty:
         st.warning("Keine Daten für die gewählten Filter gefunden.")
         return
-    
+
+    # Einmal berechnen statt im Footer erneut die ganze Stundenspalte zu scannen
+    last_date = filtered['Datum'].max()
+
+    # Lückenanalyse einmal pro Rerun — Jahresvergleich und Datenqualität
+    # lesen beide daraus
+    gap_analysis = analyze_data_gaps(data)
+
+    # Einmalige Vor-Aggregation: die Zeit-Charts ziehen ihre Aggregate aus dem
+    # über Spuren/Klassen verdichteten Zeit-Cube, die Klassen-Charts aus dem
+    # kleinen Klassen-Cube — statt die Stundentabelle pro Grafik neu zu hashen
+    time_cube = build_time_cube(filtered)
+    class_cube = build_class_cube(filtered)
+
     # === KPI KACHELN ===
     st.markdown("---")
     col1, col2, col3, col4 = st.columns(4)
     
-    total_vehicles = filtered['Anzahl'].sum()
-    avg_daily = filtered.groupby('Datum_Tag')['Anzahl'].sum().mean()
-    peak_hour_data = filtered.groupby('Stunde')['Anzahl'].sum()
-    peak_hour = peak_hour_data.idxmax()
-    days_count = filtered['Datum_Tag'].nunique()
+    # Alle vier KPIs aus einer kleinen (Datum_Tag × Stunde)-Zwischensumme
+    # statt vier separater Scans über filtered
+    kpi_agg = time_cube.groupby(level=['Datum_Tag', 'Stunde'], observed=True)['Summe'].sum()
+    total_vehicles = kpi_agg.sum()
+    avg_daily = kpi_agg.groupby(level='Datum_Tag', observed=True).sum().mean()
+    peak_hour = kpi_agg.groupby(level='Stunde', observed=True).sum().idxmax()
+    days_count = kpi_agg.index.get_level_values('Datum_Tag').nunique()
     
     with col1:
         st.metric(label="Fahrzeuge gesamt", value=format_number(total_vehicles))
@@ -316,41 +778,38 @@ def main():
     # Daten für die letzten 7 Tage (aus Gesamtdaten, unabhängig von Filterung)
     max_datum = data['Datum'].max()
     start_7_tage = max_datum - timedelta(days=7)
-    
-    data_7_tage = data[
-        (data['Datum'] >= start_7_tage) &
-        (data['Kategorie'].isin(['Personenwagen', 'Lastwagen', 'Lieferwagen']))
-    ]
-    
-    if not data_7_tage.empty:
-        # Aggregieren nach Stunde und Kategorie (stündliche Werte)
-        hourly_7_tage = data_7_tage.groupby(['Datum', 'Kategorie'])['Anzahl'].sum().reset_index()
-        hourly_7_tage['Anzahl_fmt'] = hourly_7_tage['Anzahl'].apply(lambda x: format_number_ch(x))
-        hourly_7_tage['Datum_Label'] = hourly_7_tage['Datum'].dt.strftime('%a %d.%m. %H:%M')
-        
+
+    # Memoisiert über (Jahre, max_datum): Filter-Interaktionen in der Sidebar
+    # lösen die 7-Tage-Aggregation nicht erneut aus
+    hourly_7_tage, daily_totals = compute_7_tage(jahre_key, max_datum)
+
+    if hourly_7_tage is not None:
         kategorie_farben_7t = {
             'Personenwagen': '#3498db',
             'Lieferwagen': '#2ecc71', 
             'Lastwagen': '#9b59b6'
         }
         
-        # Liniendiagramm mit Stundenwerten
-        fig_7_tage = px.line(
-            hourly_7_tage, 
-            x='Datum', 
-            y='Anzahl', 
-            color='Kategorie',
-            labels={'Datum': 'Datum/Zeit', 'Anzahl': 'Fahrzeuge/Stunde', 'Kategorie': 'Kategorie'},
-            color_discrete_map=kategorie_farben_7t,
-            custom_data=['Anzahl_fmt', 'Kategorie', 'Datum_Label']
-        )
-        fig_7_tage.update_traces(
-            hovertemplate='%{customdata[2]}<br>%{customdata[1]}: %{customdata[0]}<extra></extra>',
-            line=dict(width=2)
-        )
+        # Liniendiagramm mit Stundenwerten — direkt als go.Scatter aus den
+        # fertigen Arrays, ohne den px-DataFrame-Umweg
+        fig_7_tage = go.Figure()
+        for kategorie, farbe in kategorie_farben_7t.items():
+            kat_data = hourly_7_tage[hourly_7_tage['Kategorie'] == kategorie]
+            if kat_data.empty:
+                continue
+            fig_7_tage.add_trace(go.Scatter(
+                x=kat_data['Datum'].to_numpy(),
+                y=kat_data['Anzahl'].to_numpy(),
+                mode='lines', name=kategorie,
+                line=dict(color=farbe, width=2),
+                customdata=np.column_stack([kat_data['Anzahl_fmt'], kat_data['Datum_Label']]),
+                hovertemplate='%{customdata[1]}<br>' + kategorie + ': %{customdata[0]}<extra></extra>'
+            ))
         fig_7_tage.update_layout(
             hovermode='x unified',
+            yaxis=dict(title='Fahrzeuge/Stunde'),
             xaxis=dict(
+                title='Datum/Zeit',
                 tickformat='%a %d.%m.',
                 dtick='D1'
             ),
@@ -382,7 +841,6 @@ def main():
             
             st.markdown("---")
             st.markdown("**Ø pro Tag (7 Tage)**")
-            daily_totals = data_7_tage.groupby(['Datum_Tag', 'Kategorie'])['Anzahl'].sum().reset_index()
             for kategorie in ['Personenwagen', 'Lieferwagen', 'Lastwagen']:
                 kat_data = daily_totals[daily_totals['Kategorie'] == kategorie]
                 if not kat_data.empty:
@@ -406,8 +864,8 @@ def main():
     
     with col_left:
         # Tagesverlauf nach Richtung
-        hourly_dir = filtered.groupby(['Richtung', 'Stunde'])['Anzahl'].mean().reset_index()
-        hourly_dir['Anzahl_fmt'] = hourly_dir['Anzahl'].apply(lambda x: format_number_ch(x))
+        hourly_dir = cube_mean(time_cube, ['Richtung', 'Stunde'])
+        hourly_dir['Anzahl_fmt'] = format_series_ch(hourly_dir['Anzahl'])
         fig_hourly_dir = px.line(
             hourly_dir, x='Stunde', y='Anzahl', color='Richtung',
             labels={'Stunde': 'Uhrzeit', 'Anzahl': 'Ø Fahrzeuge/Stunde', 'Richtung': 'Richtung'},
@@ -420,10 +878,10 @@ def main():
     
     with col_right:
         # Wochenverlauf nach Richtung
-        daily_totals_dir = filtered.groupby(['Datum_Tag', 'Wochentag', 'Richtung'])['Anzahl'].sum().reset_index()
-        weekly_dir = daily_totals_dir.groupby(['Richtung', 'Wochentag'])['Anzahl'].mean().reset_index()
+        daily_totals_dir = cube_sum(time_cube, ['Datum_Tag', 'Wochentag', 'Richtung'])
+        weekly_dir = daily_totals_dir.groupby(['Richtung', 'Wochentag'], sort=False, observed=True)['Anzahl'].mean().reset_index()
         weekly_dir['Wochentag_Name'] = weekly_dir['Wochentag'].map({i: d for i, d in enumerate(['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So'])})
-        weekly_dir['Anzahl_fmt'] = weekly_dir['Anzahl'].apply(lambda x: format_number_ch(x))
+        weekly_dir['Anzahl_fmt'] = format_series_ch(weekly_dir['Anzahl'])
         fig_weekly_dir = px.bar(
             weekly_dir, x='Wochentag_Name', y='Anzahl', color='Richtung', barmode='group',
             labels={'Wochentag_Name': 'Wochentag', 'Anzahl': 'Ø Fahrzeuge/Tag', 'Richtung': 'Richtung'},
@@ -440,8 +898,8 @@ def main():
         col_left_yr, col_right_yr = st.columns(2)
         
         with col_left_yr:
-            hourly_yr = filtered.groupby(['Jahr', 'Stunde'])['Anzahl'].mean().reset_index()
-            hourly_yr['Anzahl_fmt'] = hourly_yr['Anzahl'].apply(lambda x: format_number_ch(x))
+            hourly_yr = cube_mean(time_cube, ['Jahr', 'Stunde'])
+            hourly_yr['Anzahl_fmt'] = format_series_ch(hourly_yr['Anzahl'])
             fig_hourly_yr = px.line(
                 hourly_yr, x='Stunde', y='Anzahl', color='Jahr',
                 labels={'Stunde': 'Uhrzeit', 'Anzahl': 'Ø Fahrzeuge/Stunde', 'Jahr': 'Jahr'},
@@ -452,10 +910,10 @@ def main():
             st.plotly_chart(fig_hourly_yr, use_container_width=True)
         
         with col_right_yr:
-            daily_totals_yr = filtered.groupby(['Datum_Tag', 'Wochentag', 'Jahr'])['Anzahl'].sum().reset_index()
-            weekly_yr = daily_totals_yr.groupby(['Jahr', 'Wochentag'])['Anzahl'].mean().reset_index()
+            daily_totals_yr = cube_sum(time_cube, ['Datum_Tag', 'Wochentag', 'Jahr'])
+            weekly_yr = daily_totals_yr.groupby(['Jahr', 'Wochentag'], sort=False, observed=True)['Anzahl'].mean().reset_index()
             weekly_yr['Wochentag_Name'] = weekly_yr['Wochentag'].map({i: d for i, d in enumerate(['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So'])})
-            weekly_yr['Anzahl_fmt'] = weekly_yr['Anzahl'].apply(lambda x: format_number_ch(x))
+            weekly_yr['Anzahl_fmt'] = format_series_ch(weekly_yr['Anzahl'])
             weekly_yr['Jahr'] = weekly_yr['Jahr'].astype(str)  # Als String für diskrete Farben
             fig_weekly_yr = px.bar(
                 weekly_yr, x='Wochentag_Name', y='Anzahl', color='Jahr', barmode='group',
@@ -473,61 +931,47 @@ def main():
     st.caption("Durchschnittlicher Stundenverlauf für jeden Wochentag über alle ausgewählten Jahre")
     
     wochentag_namen_full = ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag']
-    
-    # Erste Reihe: Mo-Do
-    col_mo, col_di, col_mi, col_do = st.columns(4)
-    wochentag_cols_row1 = [col_mo, col_di, col_mi, col_do]
-    
-    for idx, col in enumerate(wochentag_cols_row1):
-        with col:
-            wt_data = filtered[filtered['Wochentag'] == idx]
-            if not wt_data.empty:
-                hourly_wt_avg = wt_data.groupby('Stunde')['Anzahl'].mean().reset_index()
-                hourly_wt_avg['Anzahl_fmt'] = hourly_wt_avg['Anzahl'].apply(lambda x: format_number_ch(x))
-                fig_wt = px.line(hourly_wt_avg, x='Stunde', y='Anzahl', markers=True,
-                                 color_discrete_sequence=['#2c3e50'], custom_data=['Anzahl_fmt'])
-                fig_wt.update_traces(hovertemplate='%{customdata[0]}<extra></extra>')
-                fig_wt.update_layout(
-                    title=dict(text=wochentag_namen_full[idx], font=dict(size=14)),
-                    xaxis=dict(tickmode='linear', tick0=0, dtick=4, title=''),
-                    yaxis=dict(title='Ø Fz/h'), height=250,
-                    margin=dict(l=40, r=20, t=40, b=30), hovermode='x unified'
-                )
-                st.plotly_chart(fig_wt, use_container_width=True)
-            else:
-                st.info(f"Keine Daten für {wochentag_namen_full[idx]}")
-    
-    # Zweite Reihe: Fr-So + Vergleich
+
+    # Eine Pivot-Tabelle (Stunde × Wochentag) für alle sieben Kleindiagramme,
+    # statt sieben Boolean-Masken-Kopien von filtered
+    hourly_wt_tbl = cube_mean(time_cube, ['Wochentag', 'Stunde']).pivot(
+        index='Stunde', columns='Wochentag', values='Anzahl'
+    )
+
+    # Zwei Reihen à 4 Spalten: Mo-Do, dann Fr-So + Vergleich
+    wochentag_cols_row1 = st.columns(4)
     col_fr, col_sa, col_so, col_empty = st.columns(4)
-    wochentag_cols_row2 = [(4, col_fr), (5, col_sa), (6, col_so)]
-    
-    for idx, col in wochentag_cols_row2:
+    wochentag_cols = list(enumerate(wochentag_cols_row1)) + [(4, col_fr), (5, col_sa), (6, col_so)]
+
+    for idx, col in wochentag_cols:
         with col:
-            wt_data = filtered[filtered['Wochentag'] == idx]
-            if not wt_data.empty:
-                hourly_wt_avg = wt_data.groupby('Stunde')['Anzahl'].mean().reset_index()
-                hourly_wt_avg['Anzahl_fmt'] = hourly_wt_avg['Anzahl'].apply(lambda x: format_number_ch(x))
-                fig_wt = px.line(hourly_wt_avg, x='Stunde', y='Anzahl', markers=True,
-                                 color_discrete_sequence=['#2c3e50'], custom_data=['Anzahl_fmt'])
-                fig_wt.update_traces(hovertemplate='%{customdata[0]}<extra></extra>')
+            if idx in hourly_wt_tbl.columns:
+                fig_wt = go.Figure(go.Scatter(
+                    x=hourly_wt_tbl.index.to_numpy(),
+                    y=hourly_wt_tbl[idx].to_numpy(),
+                    mode='lines+markers', line=dict(color='#2c3e50'),
+                    customdata=format_series_ch(hourly_wt_tbl[idx]).to_numpy(),
+                    hovertemplate='%{customdata}<extra></extra>'
+                ))
                 fig_wt.update_layout(
                     title=dict(text=wochentag_namen_full[idx], font=dict(size=14)),
                     xaxis=dict(tickmode='linear', tick0=0, dtick=4, title=''),
                     yaxis=dict(title='Ø Fz/h'), height=250,
-                    margin=dict(l=40, r=20, t=40, b=30), hovermode='x unified'
+                    margin=dict(l=40, r=20, t=40, b=30), hovermode='x unified',
+                    showlegend=False
                 )
                 st.plotly_chart(fig_wt, use_container_width=True)
             else:
                 st.info(f"Keine Daten für {wochentag_namen_full[idx]}")
-    
+
     # Vergleichsdiagramm
     with col_empty:
         st.markdown("**Vergleich**")
-        hourly_all_wt_avg = filtered.groupby(['Wochentag', 'Stunde'])['Anzahl'].mean().reset_index()
+        hourly_all_wt_avg = cube_mean(time_cube, ['Wochentag', 'Stunde'])
         hourly_all_wt_avg['Wochentag_Name'] = hourly_all_wt_avg['Wochentag'].map(
             {i: d for i, d in enumerate(['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So'])}
         )
-        hourly_all_wt_avg['Anzahl_fmt'] = hourly_all_wt_avg['Anzahl'].apply(lambda x: format_number_ch(x))
+        hourly_all_wt_avg['Anzahl_fmt'] = format_series_ch(hourly_all_wt_avg['Anzahl'])
         fig_compare = px.line(
             hourly_all_wt_avg, x='Stunde', y='Anzahl', color='Wochentag_Name',
             category_orders={'Wochentag_Name': ['Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So']},
@@ -551,21 +995,23 @@ def main():
         tab_detail, tab_kategorie = st.tabs(["Detailliert", "Kategorien"])
         
         with tab_detail:
-            by_class = filtered.groupby('Klasse.Text')['Anzahl'].sum().reset_index()
+            by_class = cube_sum(class_cube, ['Klasse.Text'])
             total = by_class['Anzahl'].sum()
             by_class['Prozent'] = (by_class['Anzahl'] / total * 100).round(1)
             by_class = by_class.sort_values('Prozent', ascending=True)
-            by_class['Prozent_fmt'] = by_class['Prozent'].apply(lambda x: f"{x:.1f}%")
-            by_class['Anzahl_fmt'] = by_class['Anzahl'].apply(lambda x: format_number_ch(x))
-            fig_classes = px.bar(
-                by_class, x='Prozent', y='Klasse.Text', orientation='h',
-                labels={'Klasse.Text': '', 'Prozent': 'Anteil (%)'},
-                color='Klasse.Text', color_discrete_map=FARBEN, text='Prozent',
-                custom_data=['Prozent_fmt', 'Anzahl_fmt']
-            )
-            fig_classes.update_traces(texttemplate='%{text:.1f}%', textposition='outside',
-                                       hovertemplate='%{y}: %{customdata[0]} (%{customdata[1]} Fz.)<extra></extra>')
-            fig_classes.update_layout(showlegend=False, xaxis=dict(range=[0, 100]))
+            by_class['Prozent_fmt'] = by_class['Prozent'].round(1).astype(str) + '%'
+            by_class['Anzahl_fmt'] = format_series_ch(by_class['Anzahl'])
+            klassen_arr = by_class['Klasse.Text'].astype(str).to_numpy()
+            fig_classes = go.Figure(go.Bar(
+                x=by_class['Prozent'].to_numpy(), y=klassen_arr, orientation='h',
+                marker_color=[FARBEN.get(k, '#95a5a6') for k in klassen_arr],
+                text=by_class['Prozent'].to_numpy(),
+                texttemplate='%{text:.1f}%', textposition='outside',
+                customdata=np.column_stack([by_class['Prozent_fmt'], by_class['Anzahl_fmt']]),
+                hovertemplate='%{y}: %{customdata[0]} (%{customdata[1]} Fz.)<extra></extra>'
+            ))
+            fig_classes.update_layout(showlegend=False,
+                                       xaxis=dict(range=[0, 100], title='Anteil (%)'))
             st.plotly_chart(fig_classes, use_container_width=True)
         
         with tab_kategorie:
@@ -573,27 +1019,29 @@ def main():
                 'Personenwagen': '#3498db', 'Lieferwagen': '#2ecc71', 'Motorrad': '#e74c3c',
                 'Lastwagen': '#9b59b6', 'Bus/Trolleybus': '#f39c12', 'Unbekannt': '#95a5a6'
             }
-            by_kategorie = filtered.groupby('Kategorie')['Anzahl'].sum().reset_index()
+            by_kategorie = cube_sum(class_cube, ['Kategorie'])
             total_kat = by_kategorie['Anzahl'].sum()
             by_kategorie['Prozent'] = (by_kategorie['Anzahl'] / total_kat * 100).round(1)
             by_kategorie = by_kategorie.sort_values('Prozent', ascending=True)
-            by_kategorie['Prozent_fmt'] = by_kategorie['Prozent'].apply(lambda x: f"{x:.1f}%")
-            by_kategorie['Anzahl_fmt'] = by_kategorie['Anzahl'].apply(lambda x: format_number_ch(x))
-            fig_kategorien = px.bar(
-                by_kategorie, x='Prozent', y='Kategorie', orientation='h',
-                labels={'Kategorie': '', 'Prozent': 'Anteil (%)'},
-                color='Kategorie', color_discrete_map=kategorie_farben, text='Prozent',
-                custom_data=['Prozent_fmt', 'Anzahl_fmt']
-            )
-            fig_kategorien.update_traces(texttemplate='%{text:.1f}%', textposition='outside',
-                                          hovertemplate='%{y}: %{customdata[0]} (%{customdata[1]} Fz.)<extra></extra>')
-            fig_kategorien.update_layout(showlegend=False, xaxis=dict(range=[0, 100]))
+            by_kategorie['Prozent_fmt'] = by_kategorie['Prozent'].round(1).astype(str) + '%'
+            by_kategorie['Anzahl_fmt'] = format_series_ch(by_kategorie['Anzahl'])
+            kategorien_arr = by_kategorie['Kategorie'].astype(str).to_numpy()
+            fig_kategorien = go.Figure(go.Bar(
+                x=by_kategorie['Prozent'].to_numpy(), y=kategorien_arr, orientation='h',
+                marker_color=[kategorie_farben.get(k, '#95a5a6') for k in kategorien_arr],
+                text=by_kategorie['Prozent'].to_numpy(),
+                texttemplate='%{text:.1f}%', textposition='outside',
+                customdata=np.column_stack([by_kategorie['Prozent_fmt'], by_kategorie['Anzahl_fmt']]),
+                hovertemplate='%{y}: %{customdata[0]} (%{customdata[1]} Fz.)<extra></extra>'
+            ))
+            fig_kategorien.update_layout(showlegend=False,
+                                          xaxis=dict(range=[0, 100], title='Anteil (%)'))
             st.plotly_chart(fig_kategorien, use_container_width=True)
     
     with col_right2:
         st.subheader("↔️ Richtungsvergleich")
-        by_direction = filtered.groupby('Richtung')['Anzahl'].sum().reset_index()
-        by_direction['Anzahl_fmt'] = by_direction['Anzahl'].apply(lambda x: format_number_ch(x))
+        by_direction = cube_sum(class_cube, ['Richtung'])
+        by_direction['Anzahl_fmt'] = format_series_ch(by_direction['Anzahl'])
         by_direction['Prozent'] = (by_direction['Anzahl'] / by_direction['Anzahl'].sum() * 100).round(1)
         fig_direction = px.pie(
             by_direction, values='Anzahl', names='Richtung', hole=0.4,
@@ -614,15 +1062,15 @@ def main():
             'Lastwagen': '#9b59b6', 'Bus/Trolleybus': '#f39c12', 'Unbekannt': '#95a5a6'
         }
         
-        yearly_by_cat = filtered.groupby(['Jahr', 'Kategorie'])['Anzahl'].sum().reset_index()
-        yearly_totals = yearly_by_cat.groupby('Jahr')['Anzahl'].sum().reset_index()
+        yearly_by_cat = cube_sum(class_cube, ['Jahr', 'Kategorie'])
+        yearly_totals = yearly_by_cat.groupby('Jahr', sort=False, observed=True)['Anzahl'].sum().reset_index()
         yearly_totals.columns = ['Jahr', 'Total']
         yearly_by_cat = yearly_by_cat.merge(yearly_totals, on='Jahr')
         yearly_by_cat['Prozent'] = (yearly_by_cat['Anzahl'] / yearly_by_cat['Total'] * 100).round(2)
-        yearly_by_cat['Prozent_fmt'] = yearly_by_cat['Prozent'].apply(lambda x: f"{x:.1f}%")
-        yearly_by_cat['Anzahl_fmt'] = yearly_by_cat['Anzahl'].apply(lambda x: format_number_ch(x))
+        yearly_by_cat['Prozent_fmt'] = yearly_by_cat['Prozent'].round(1).astype(str) + '%'
+        yearly_by_cat['Anzahl_fmt'] = format_series_ch(yearly_by_cat['Anzahl'])
         
-        cat_order = yearly_by_cat.groupby('Kategorie')['Prozent'].mean().sort_values(ascending=False).index.tolist()
+        cat_order = yearly_by_cat.groupby('Kategorie', sort=False, observed=True)['Prozent'].mean().sort_values(ascending=False).index.tolist()
         
         fig_cat_trend = make_subplots(specs=[[{"secondary_y": True}]])
         
@@ -667,48 +1115,31 @@ def main():
     st.markdown("---")
     st.subheader("Monatlicher Verkehrstrend (Ø Tagesverkehr)")
     
-    import calendar
-    daily_totals_monthly = filtered.groupby(['Jahr', 'Monat', 'Datum_Tag', 'Richtung'])['Anzahl'].sum().reset_index()
-    monthly_stats = daily_totals_monthly.groupby(['Jahr', 'Monat', 'Richtung']).agg(
-        Anzahl=('Anzahl', 'mean'), Tage=('Datum_Tag', 'nunique')
-    ).reset_index()
-    monthly_stats['Erwartete_Tage'] = monthly_stats.apply(
-        lambda row: calendar.monthrange(int(row['Jahr']), int(row['Monat']))[1], axis=1
-    )
-    monthly_stats['Abdeckung'] = monthly_stats['Tage'] / monthly_stats['Erwartete_Tage']
-    monthly = monthly_stats[monthly_stats['Abdeckung'] >= 0.9].copy()
-    monthly['Datum'] = pd.to_datetime(monthly['Jahr'].astype(str) + '-' + monthly['Monat'].astype(str) + '-15')
-    monthly['Anzahl_fmt'] = monthly['Anzahl'].apply(lambda x: format_number_ch(x))
-    
-    fig_trend = px.bar(
-        monthly, x='Datum', y='Anzahl', color='Richtung', barmode='group',
-        labels={'Datum': '', 'Anzahl': 'Ø Fahrzeuge/Tag', 'Richtung': 'Richtung'},
-        color_discrete_sequence=['#3498db', '#e74c3c'], custom_data=['Anzahl_fmt']
-    )
-    fig_trend.update_traces(hovertemplate='%{customdata[0]}<extra></extra>')
-    
-    shapes, annotations = [], []
-    jahre_im_datensatz = monthly['Jahr'].unique()
-    
-    if 2020 in jahre_im_datensatz:
-        shapes.append(dict(type="rect", xref="x", yref="paper", x0="2020-03-01", x1="2020-06-01",
-                           y0=0, y1=1, fillcolor="rgba(255, 0, 0, 0.1)", line=dict(width=0), layer="below"))
-        annotations.append(dict(x="2020-04-15", y=1.02, xref="x", yref="paper", text="Lockdown",
-                                showarrow=False, font=dict(size=10, color="#e74c3c"), bgcolor="rgba(255,255,255,0.8)"))
-    
-    for jahr in jahre_im_datensatz:
-        shapes.append(dict(type="rect", xref="x", yref="paper", x0=f"{jahr}-07-01", x1=f"{jahr}-09-01",
-                           y0=0, y1=1, fillcolor="rgba(255, 193, 7, 0.1)", line=dict(width=0), layer="below"))
-    
-    if len(jahre_im_datensatz) > 0:
-        first_year = min(jahre_im_datensatz)
-        annotations.append(dict(x=f"{first_year}-08-01", y=1.02, xref="x", yref="paper", text="Sommerferien",
-                                showarrow=False, font=dict(size=10, color="#f39c12"), bgcolor="rgba(255,255,255,0.8)"))
-    
-    for jahr in sorted(jahre_im_datensatz)[1:]:
-        shapes.append(dict(type="line", xref="x", yref="paper", x0=f"{jahr}-01-01", x1=f"{jahr}-01-01",
-                           y0=0, y1=1, line=dict(color="rgba(0,0,0,0.3)", width=1, dash="dash")))
-    
+    monthly = compute_monthly_stats(jahre_key, richtungen_key, klassen_key, wochentage_key)
+
+    # Direkt als go.Bar aus den fertigen Arrays, ohne den px-Umweg über
+    # DataFrame-Validierung und Dtype-Inferenz pro Trace
+    fig_trend = go.Figure()
+    for i, richtung in enumerate(monthly['Richtung'].unique()):
+        sub = monthly[monthly['Richtung'] == richtung]
+        fig_trend.add_trace(go.Bar(
+            x=sub['Datum'].to_numpy(), y=sub['Anzahl'].to_numpy(), name=str(richtung),
+            marker_color=['#3498db', '#e74c3c'][i % 2],
+            customdata=sub['Anzahl_fmt'].to_numpy(),
+            hovertemplate='%{customdata}<extra></extra>'
+        ))
+    fig_trend.update_layout(barmode='group', yaxis=dict(title='Ø Fahrzeuge/Tag'),
+                            legend=dict(title='Richtung'))
+    
+    # Shapes/Annotations hängen nur an den Jahren im Datensatz → einmal bauen
+    # und in session_state memoisiert wiederverwenden
+    # Einmal sortieren — build_trend_shapes braucht danach weder min() noch sorted()
+    jahre_im_datensatz = tuple(np.sort(monthly['Jahr'].unique()).tolist())
+    trend_shapes_key = 'trend_shapes_' + '_'.join(map(str, jahre_im_datensatz))
+    if trend_shapes_key not in st.session_state:
+        st.session_state[trend_shapes_key] = build_trend_shapes(jahre_im_datensatz)
+    shapes, annotations = st.session_state[trend_shapes_key]
+
     fig_trend.update_layout(hovermode='x unified', bargap=0.1, shapes=shapes, annotations=annotations, margin=dict(t=40))
     st.plotly_chart(fig_trend, use_container_width=True)
     st.caption("Rot = COVID-19 Lockdown (März-Mai 2020) | Gelb = Sommerferien Zürich (Juli/August)")
@@ -717,56 +1148,26 @@ def main():
     st.markdown("---")
     st.subheader("Jahresverlauf (Wochendurchschnitt)")
     
-    daily_totals_weekly = filtered.groupby(['Jahr', 'Kalenderwoche', 'Datum_Tag'])['Anzahl'].sum().reset_index()
-    
-    kw53_data = daily_totals_weekly[daily_totals_weekly['Kalenderwoche'] == 53].copy()
-    if not kw53_data.empty:
-        kw53_data['Jahr'] = kw53_data['Jahr'] + 1
-        kw53_data['Kalenderwoche'] = 1
-        daily_totals_weekly = pd.concat([daily_totals_weekly, kw53_data], ignore_index=True)
-    
-    daily_totals_weekly = daily_totals_weekly[daily_totals_weekly['Kalenderwoche'] <= 52]
-    
-    weekly_stats_kw = daily_totals_weekly.groupby(['Jahr', 'Kalenderwoche']).agg(
-        Anzahl=('Anzahl', 'mean'), Tage=('Datum_Tag', 'nunique')
-    ).reset_index()
-    weekly_stats_kw.loc[weekly_stats_kw['Tage'] < 5, 'Anzahl'] = np.nan
-    weekly_stats_kw.loc[(weekly_stats_kw['Jahr'] == 2020) & (weekly_stats_kw['Kalenderwoche'] < 4), 'Anzahl'] = np.nan
-    
-    weekly_avg = weekly_stats_kw[['Jahr', 'Kalenderwoche', 'Anzahl']].copy()
-    weekly_avg['Anzahl_fmt'] = weekly_avg['Anzahl'].apply(lambda x: format_number_ch(x) if pd.notna(x) else '–')
-    weekly_avg['Jahr'] = weekly_avg['Jahr'].astype(str)
-    
-    fig_weekly = px.line(
-        weekly_avg, x='Kalenderwoche', y='Anzahl', color='Jahr',
-        labels={'Kalenderwoche': 'Kalenderwoche', 'Anzahl': 'Ø Fahrzeuge/Tag', 'Jahr': 'Jahr'},
-        markers=True, custom_data=['Anzahl_fmt', 'Jahr']
-    )
-    fig_weekly.update_traces(hovertemplate='KW %{x}: %{customdata[0]}<extra>%{customdata[1]}</extra>', connectgaps=False)
-    
-    weekly_shapes = []
-    weekly_annotations = []
-    
-    if '2020' in weekly_avg['Jahr'].values:
-        weekly_shapes.append(dict(type="rect", xref="x", yref="paper", x0=11, x1=20,
-                                  y0=0, y1=1, fillcolor="rgba(255, 0, 0, 0.1)", line=dict(width=0), layer="below"))
-        weekly_annotations.append(dict(x=15, y=1.02, xref="x", yref="paper", text="Lockdown",
-                                       showarrow=False, font=dict(size=10, color="#e74c3c"), bgcolor="rgba(255,255,255,0.8)"))
-    
-    weekly_shapes.append(dict(type="rect", xref="x", yref="paper", x0=28, x1=33,
-                              y0=0, y1=1, fillcolor="rgba(255, 193, 7, 0.1)", line=dict(width=0), layer="below"))
-    weekly_annotations.append(dict(x=30.5, y=1.02, xref="x", yref="paper", text="Ferien",
-                                   showarrow=False, font=dict(size=10, color="#f39c12"), bgcolor="rgba(255,255,255,0.8)"))
-    
-    weekly_shapes.extend([
-        dict(type="rect", xref="x", yref="paper", x0=51, x1=52.5, y0=0, y1=1,
-             fillcolor="rgba(76, 175, 80, 0.1)", line=dict(width=0), layer="below"),
-        dict(type="rect", xref="x", yref="paper", x0=0.5, x1=2, y0=0, y1=1,
-             fillcolor="rgba(76, 175, 80, 0.1)", line=dict(width=0), layer="below")
-    ])
-    weekly_annotations.append(dict(x=52, y=1.02, xref="x", yref="paper", text="",
-                                   showarrow=False, font=dict(size=10), bgcolor="rgba(255,255,255,0.8)"))
-    
+    weekly_avg = compute_weekly_stats(jahre_key, richtungen_key, klassen_key, wochentage_key)
+
+    # Scattergl: GL-Vertices statt SVG-DOM-Knoten (52 Marker × Jahr)
+    fig_weekly = go.Figure()
+    for jahr in weekly_avg['Jahr'].unique():
+        sub = weekly_avg[weekly_avg['Jahr'] == jahr]
+        fig_weekly.add_trace(go.Scattergl(
+            x=sub['Kalenderwoche'].to_numpy(), y=sub['Anzahl'].to_numpy(),
+            mode='lines+markers', name=jahr, connectgaps=False,
+            customdata=sub['Anzahl_fmt'].to_numpy(),
+            hovertemplate='KW %{x}: %{customdata}<extra>' + jahr + '</extra>'
+        ))
+    fig_weekly.update_layout(yaxis=dict(title='Ø Fahrzeuge/Tag'), legend=dict(title='Jahr'))
+    
+    has_2020 = '2020' in weekly_avg['Jahr'].values
+    weekly_shapes_key = f'weekly_shapes_{has_2020}'
+    if weekly_shapes_key not in st.session_state:
+        st.session_state[weekly_shapes_key] = build_weekly_shapes(has_2020)
+    weekly_shapes, weekly_annotations = st.session_state[weekly_shapes_key]
+
     fig_weekly.update_layout(xaxis=dict(tickmode='linear', tick0=1, dtick=4, range=[0.5, 52.5]),
                               hovermode='x unified', shapes=weekly_shapes, annotations=weekly_annotations, margin=dict(t=40))
     st.plotly_chart(fig_weekly, use_container_width=True)
@@ -776,28 +1177,14 @@ def main():
     st.markdown("---")
     st.subheader("🗓️ Verkehrsmuster: Stunde × Wochentag")
     
-    wochentag_labels = {0: 'Mo', 1: 'Di', 2: 'Mi', 3: 'Do', 4: 'Fr', 5: 'Sa', 6: 'So'}
-    heatmap_data = filtered.groupby(['Wochentag', 'Stunde'])['Anzahl'].mean().reset_index()
-    
-    daily_totals_wt = filtered.groupby(['Datum_Tag', 'Wochentag'])['Anzahl'].sum().reset_index()
-    avg_daily_by_wt = daily_totals_wt.groupby('Wochentag')['Anzahl'].mean().round(0).astype(int)
-    wochentag_labels_mit_summe = {
-        i: f"{wochentag_labels[i]} (Ø {avg_daily_by_wt.get(i, 0):,}/Tag)".replace(',', "'") for i in range(7)
-    }
-    
-    all_combinations = pd.MultiIndex.from_product([range(7), range(24)], names=['Wochentag', 'Stunde']).to_frame(index=False)
-    heatmap_complete = all_combinations.merge(heatmap_data, on=['Wochentag', 'Stunde'], how='left')
-    heatmap_complete['Anzahl'] = heatmap_complete['Anzahl'].fillna(0)
-    heatmap_pivot = heatmap_complete.pivot(index='Wochentag', columns='Stunde', values='Anzahl')
-    heatmap_pivot.index = [wochentag_labels_mit_summe[i] for i in heatmap_pivot.index]
-    heatmap_hover = heatmap_pivot.map(lambda x: f"Ø {format_number_ch(x)} Fz./h")
-    
+    heatmap_pivot, heatmap_hover = compute_heatmap(jahre_key, richtungen_key, klassen_key, wochentage_key)
+
     fig_heatmap = px.imshow(
         heatmap_pivot, labels=dict(x="Stunde", y="Wochentag", color="Ø Fahrzeuge/h"),
         aspect="auto", color_continuous_scale="YlOrRd"
     )
     fig_heatmap.update_traces(hovertemplate='%{y}<br>%{x}:00 Uhr<br>%{customdata}<extra></extra>',
-                               customdata=heatmap_hover.values)
+                               customdata=heatmap_hover)
     fig_heatmap.update_layout(height=350)
     st.plotly_chart(fig_heatmap, use_container_width=True)
     
@@ -806,28 +1193,28 @@ def main():
         st.markdown("---")
         st.subheader("Jahresvergleich (Ø Tagesverkehr)")
         
-        gap_analysis = analyze_data_gaps(data)
-        
-        daily_by_year_total = filtered.groupby(['Jahr', 'Datum_Tag'])['Anzahl'].sum().reset_index()
-        yearly_total = daily_by_year_total.groupby('Jahr')['Anzahl'].mean().reset_index()
-        
+        daily_by_year_total, yearly_total, yearly, yearly_sum, yearly_total_sum = compute_yearly(
+            jahre_key, richtungen_key, klassen_key, wochentage_key
+        )
+
+        # O(1)-Lookups statt wiederholter Listen-Scans (next(...)) und iterrows
+        yearly_stats_by_year = {s['jahr']: s for s in gap_analysis['yearly_stats']}
+        days_by_year = daily_by_year_total.groupby('Jahr', sort=False, observed=True)['Datum_Tag'].nunique().to_dict()
+
         yearly_corrected = []
-        for _, row in yearly_total.iterrows():
-            jahr = row['Jahr']
-            avg_dtv = row['Anzahl']
-            days_with_data = daily_by_year_total[daily_by_year_total['Jahr'] == jahr]['Datum_Tag'].nunique()
-            year_stat = next((s for s in gap_analysis['yearly_stats'] if s['jahr'] == jahr), None)
-            gap_days = year_stat['gap_days'] if year_stat else 0
-            vollst = year_stat['completeness'] if year_stat else 100
+        for jahr, avg_dtv in yearly_total.set_index('Jahr')['Anzahl'].items():
+            year_stat = yearly_stats_by_year.get(jahr)
             yearly_corrected.append({
-                'Jahr': jahr, 'DTV': avg_dtv, 'Tage_Daten': days_with_data,
-                'Tage_Lücken': gap_days, 'Vollständigkeit': vollst
+                'Jahr': jahr, 'DTV': avg_dtv, 'Tage_Daten': days_by_year.get(jahr, 0),
+                'Tage_Lücken': year_stat['gap_days'] if year_stat else 0,
+                'Vollständigkeit': year_stat['completeness'] if year_stat else 100
             })
+        yearly_corrected_by_jahr = {c['Jahr']: c for c in yearly_corrected}
         
         cols_yearly = st.columns(len(selected_jahre))
         for i, jahr in enumerate(sorted(selected_jahre)):
             with cols_yearly[i]:
-                corr_data = next((c for c in yearly_corrected if c['Jahr'] == jahr), None)
+                corr_data = yearly_corrected_by_jahr.get(jahr)
                 if corr_data:
                     formatted_val = format_number(corr_data['DTV'])
                     gap_days = corr_data['Tage_Lücken']
@@ -845,37 +1232,36 @@ def main():
             st.info("ℹ️ **Hinweis:** Einige Jahre haben grössere Datenlücken. "
                     "Der Ø Tagesverkehr (DTV) basiert nur auf den verfügbaren Tagen.")
         
-        daily_by_year = filtered.groupby(['Jahr', 'Datum_Tag', 'Richtung'])['Anzahl'].sum().reset_index()
-        yearly = daily_by_year.groupby(['Jahr', 'Richtung'])['Anzahl'].mean().reset_index()
-        yearly['Anzahl_fmt'] = yearly['Anzahl'].apply(lambda x: format_number_ch(x))
-        
         tab_dtv, tab_total = st.tabs(["Ø Tagesverkehr (DTV)", "Gesamtanzahl"])
         
         with tab_dtv:
-            fig_yearly = px.bar(
-                yearly, x='Jahr', y='Anzahl', color='Richtung', barmode='group',
-                labels={'Jahr': '', 'Anzahl': 'Ø Fahrzeuge/Tag', 'Richtung': 'Richtung'},
-                text='Anzahl_fmt', color_discrete_sequence=['#3498db', '#e74c3c'], custom_data=['Anzahl_fmt']
-            )
-            fig_yearly.update_traces(textposition='outside', hovertemplate='%{customdata[0]}<extra></extra>')
+            fig_yearly = go.Figure()
+            for i, richtung in enumerate(yearly['Richtung'].unique()):
+                sub = yearly[yearly['Richtung'] == richtung]
+                fig_yearly.add_trace(go.Bar(
+                    x=sub['Jahr'].to_numpy(), y=sub['Anzahl'].to_numpy(), name=str(richtung),
+                    marker_color=['#3498db', '#e74c3c'][i % 2],
+                    text=sub['Anzahl_fmt'].to_numpy(), textposition='outside',
+                    customdata=sub['Anzahl_fmt'].to_numpy(),
+                    hovertemplate='%{customdata}<extra></extra>'
+                ))
+            fig_yearly.update_layout(barmode='group', yaxis=dict(title='Ø Fahrzeuge/Tag'),
+                                     legend=dict(title='Richtung'))
             st.plotly_chart(fig_yearly, use_container_width=True)
         
         with tab_total:
-            yearly_sum = filtered.groupby(['Jahr', 'Richtung'])['Anzahl'].sum().reset_index()
-            yearly_sum['Anzahl_fmt'] = yearly_sum['Anzahl'].apply(lambda x: format_number_ch(x))
-            yearly_total_sum = filtered.groupby('Jahr')['Anzahl'].sum().reset_index()
-            
+            totals_by_year = yearly_total_sum.set_index('Jahr')['Anzahl'].to_dict()
             cols_total = st.columns(len(selected_jahre))
             for i, jahr in enumerate(sorted(selected_jahre)):
                 with cols_total[i]:
-                    corr_data = next((c for c in yearly_corrected if c['Jahr'] == jahr), None)
-                    total_val = yearly_total_sum[yearly_total_sum['Jahr'] == jahr]['Anzahl'].values
-                    if len(total_val) > 0 and corr_data:
-                        formatted_total = format_number(total_val[0])
+                    corr_data = yearly_corrected_by_jahr.get(jahr)
+                    total_val = totals_by_year.get(jahr)
+                    if total_val is not None and corr_data:
+                        formatted_total = format_number(total_val)
                         gap_days = corr_data['Tage_Lücken']
                         tage_daten = corr_data['Tage_Daten']
                         if gap_days > 1:
-                            schaetzung = total_val[0] * (365 / tage_daten) if tage_daten > 0 else total_val[0]
+                            schaetzung = total_val * (365 / tage_daten) if tage_daten > 0 else total_val
                             st.metric(label=f"{jahr}", value=formatted_total,
                                       help=f"Gemessene Fahrzeuge | {tage_daten} Tage mit Daten")
                             st.caption(f"Hochrechnung: ~{format_number(schaetzung)}")
@@ -883,12 +1269,18 @@ def main():
                             st.metric(label=f"{jahr}", value=formatted_total,
                                       help=f"Gemessene Fahrzeuge | {tage_daten} Tage mit Daten")
             
-            fig_yearly_sum = px.bar(
-                yearly_sum, x='Jahr', y='Anzahl', color='Richtung', barmode='group',
-                labels={'Jahr': '', 'Anzahl': 'Fahrzeuge gesamt', 'Richtung': 'Richtung'},
-                text='Anzahl_fmt', color_discrete_sequence=['#3498db', '#e74c3c'], custom_data=['Anzahl_fmt']
-            )
-            fig_yearly_sum.update_traces(textposition='outside', hovertemplate='%{customdata[0]}<extra></extra>')
+            fig_yearly_sum = go.Figure()
+            for i, richtung in enumerate(yearly_sum['Richtung'].unique()):
+                sub = yearly_sum[yearly_sum['Richtung'] == richtung]
+                fig_yearly_sum.add_trace(go.Bar(
+                    x=sub['Jahr'].to_numpy(), y=sub['Anzahl'].to_numpy(), name=str(richtung),
+                    marker_color=['#3498db', '#e74c3c'][i % 2],
+                    text=sub['Anzahl_fmt'].to_numpy(), textposition='outside',
+                    customdata=sub['Anzahl_fmt'].to_numpy(),
+                    hovertemplate='%{customdata}<extra></extra>'
+                ))
+            fig_yearly_sum.update_layout(barmode='group', yaxis=dict(title='Fahrzeuge gesamt'),
+                                         legend=dict(title='Richtung'))
             st.plotly_chart(fig_yearly_sum, use_container_width=True)
             st.caption("💡 **Hinweis:** Die Gesamtzahlen sind bei Datenlücken nicht direkt vergleichbar.")
     
@@ -896,7 +1288,6 @@ def main():
     st.markdown("---")
     st.subheader("⚠️ Datenqualität & Lücken")
     
-    gap_analysis = analyze_data_gaps(data)
     significant_gaps = [g for g in gap_analysis['gaps'] if g['duration_h'] > 1 and not g['is_dst']]
     total_gap_hours = sum(g['duration_h'] for g in significant_gaps)
     
@@ -912,12 +1303,19 @@ def main():
     
     with tab_gaps:
         if significant_gaps:
-            gap_df = pd.DataFrame([{
-                'Von': g['start'].strftime('%d.%m.%Y %H:%M'),
-                'Bis': g['end'].strftime('%d.%m.%Y %H:%M'),
-                'Dauer': f"{g['duration_h']:.1f}h" if g['duration_h'] < 24 else f"{g['duration_h']/24:.1f} Tage",
-                'Jahr': g['start'].year
-            } for g in significant_gaps])
+            # Spaltenweise (SoA) aufbauen: strftime/Formatierung vektorisiert
+            # statt ein Dict und vier Python-Aufrufe pro Zeile
+            gap_starts = pd.DatetimeIndex([g['start'] for g in significant_gaps])
+            gap_ends = pd.DatetimeIndex([g['end'] for g in significant_gaps])
+            gap_durs = np.array([g['duration_h'] for g in significant_gaps])
+            gap_df = pd.DataFrame({
+                'Von': gap_starts.strftime('%d.%m.%Y %H:%M'),
+                'Bis': gap_ends.strftime('%d.%m.%Y %H:%M'),
+                'Dauer': np.where(gap_durs < 24,
+                                  pd.Series(gap_durs).map('{:.1f}h'.format),
+                                  pd.Series(gap_durs / 24).map('{:.1f} Tage'.format)),
+                'Jahr': gap_starts.year
+            })
             st.dataframe(gap_df, use_container_width=True, hide_index=True)
         else:
             st.success("Keine signifikanten Datenlücken gefunden.")
@@ -927,12 +1325,17 @@ def main():
             st.info(f"ℹ️ {len(dst_gaps)} Lücken durch Zeitumstellung (Sommerzeit) – diese sind normal.")
     
     with tab_yearly:
-        yearly_df = pd.DataFrame([{
-            'Jahr': s['jahr'],
-            'Zeitraum': f"{s['start'].strftime('%d.%m.')} – {s['end'].strftime('%d.%m.')}",
-            'Vollständigkeit': f"{s['completeness']:.1f}%",
-            'Fehlende Tage': f"{s['gap_days']:.1f}" if s['gap_days'] > 0 else "–"
-        } for s in gap_analysis['yearly_stats']])
+        ys = gap_analysis['yearly_stats']
+        ys_starts = pd.DatetimeIndex([s['start'] for s in ys])
+        ys_ends = pd.DatetimeIndex([s['end'] for s in ys])
+        ys_gap_days = np.array([s['gap_days'] for s in ys])
+        yearly_df = pd.DataFrame({
+            'Jahr': [s['jahr'] for s in ys],
+            'Zeitraum': pd.Series(ys_starts.strftime('%d.%m.')) + ' – ' + pd.Series(ys_ends.strftime('%d.%m.')),
+            'Vollständigkeit': [f"{s['completeness']:.1f}%" for s in ys],
+            'Fehlende Tage': np.where(ys_gap_days > 0,
+                                      pd.Series(ys_gap_days).map('{:.1f}'.format), '–')
+        })
         st.dataframe(yearly_df, use_container_width=True, hide_index=True)
         
         if significant_gaps:
@@ -946,7 +1349,7 @@ def main():
         f"Datenquelle: [Open Data Zürich](https://data.stadt-zuerich.ch/dataset/ugz_verkehrsdaten_stundenwerte_rosengartenbruecke) | "
         f"Standort: Rosengartenstrasse 18, 8037 Zürich | "
         f"Intervall: 1 Stunde | "
-        f"Letzte Aktualisierung: {filtered['Datum'].max().strftime('%d.%m.%Y')}"
+        f"Letzte Aktualisierung: {last_date.strftime('%d.%m.%Y')}"
     )
 
 